@@ -4,18 +4,296 @@ Send masked transcripts to Claude API for story element coding
 Uses Document 2 v3.1 prompt with blind coding protocol
 """
 
+import argparse
+import asyncio
+import functools
+import hashlib
 import json
 import os
+import random
+import re
+import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
-from anthropic import Anthropic
+import orjson
+from anthropic import (
+    APIConnectionError,
+    APIStatusError,
+    AsyncAnthropic,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    RateLimitError,
+)
+import httpx
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
+MODEL = "claude-sonnet-4-20250514"  # Latest Sonnet 4
+
+# Responses are deterministic (temperature=0), so they are cached on disk
+# by a hash of everything that goes into the request
+CACHE_DIR = Path('data/coded/_cache')
+
+# Every coded transcript in one JSON-Lines file, so downstream analysis
+# can read a single artifact instead of re-parsing each *_coded.json
+ALL_CODED_FILE = Path('data/coded/all_coded.jsonl')
+
+# Maximum number of Claude requests in flight at once.
+# Keep this in line with your Anthropic rate-limit tier.
+MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '8'))
+
+# Anthropic per-minute budgets (requests and input tokens) for your tier
+RPM_LIMIT = int(os.getenv('LLM_RPM_LIMIT', '50'))
+TPM_LIMIT = int(os.getenv('LLM_TPM_LIMIT', '30000'))
+
+# Rough chars-per-token ratio used to estimate a request's cost up front
+CHARS_PER_TOKEN = 4
+
+# Exact token counts of system prompts, filled once per run via the API
+SYSTEM_PROMPT_TOKENS = {}
+
+# System prompts already in Anthropic's prompt cache. Cache reads don't count
+# towards the input-token rate limit, so these stop being charged to TPM
+CACHED_SYSTEM_PROMPTS = set()
+
+# With --trim-context, Stage 1 keeps only the utterances that mention a
+# name used in Stage 2, plus roughly this many tokens at its end
+STAGE_1_TAIL_TOKENS = 500
+
+# A sentence or line of a transcript, including trailing whitespace
+SENTENCE_RE = re.compile(r"[^.!?\n]*[.!?]*\s*")
+
+# Capitalised words in mid-sentence position, i.e. likely names
+# (skips sentence-initial words such as "The" or "Then")
+ENTITY_RE = re.compile(r"(?<=[a-z,] )[A-Z][a-z]+\b")
+
+# Transient failures (429, 5xx/529 overloaded, network errors and timeouts)
+# are retried with exponential backoff before a transcript counts as an error
+RETRYABLE_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+MAX_ATTEMPTS = 6
+MAX_BACKOFF_SECONDS = 60
+
+# Body of the first ``` or ```json fenced block in a response
+JSON_FENCE_RE = re.compile(r"```(?:json)?\s*(.*?)\s*```", re.DOTALL)
+
+# Output budget per transcript; a packed request gets one budget per
+# transcript, up to the model's output limit (64k tokens for Sonnet 4)
+MAX_TOKENS_PER_TRANSCRIPT = 4096
+MAX_OUTPUT_TOKENS = 64000
+
+# Largest --batch-size that still gives every transcript its full budget
+MAX_BATCH_SIZE = MAX_OUTPUT_TOKENS // MAX_TOKENS_PER_TRANSCRIPT
+
+# Usage counters recorded in each file's _api_metadata
+TOKEN_FIELDS = (
+    'input_tokens',
+    'output_tokens',
+    'cache_creation_input_tokens',
+    'cache_read_input_tokens'
+)
+
+# Sonnet 4 prices in USD per million tokens. Prompt-cache writes cost
+# 1.25x the base input price and cache reads 0.1x.
+PRICE_PER_MTOK = {
+    'input_tokens': 3.0,
+    'output_tokens': 15.0,
+    'cache_creation_input_tokens': 3.75,
+    'cache_read_input_tokens': 0.30
+}
+
+# How often to check on a submitted Message Batch
+BATCH_POLL_SECONDS = 30
+
+# Message Batches are billed at 50% of the live per-token price
+BATCH_DISCOUNT = 0.5
+
+@dataclass(slots=True)
+class Result:
+    """Outcome of coding one participant, with the tokens it was billed for"""
+    participant_id: str
+    data: dict | None = None
+    error: str | None = None
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_creation_input_tokens: int = 0
+    cache_read_input_tokens: int = 0
+
+class AsyncLeakyBucket:
+    """
+    Proactive request-rate + token-rate limiter shared by all coroutines.
+    A call is only released once both the RPM and TPM budgets have capacity.
+    After a 429, both refill rates are halved for a cool-down window.
+    """
+    
+    def __init__(self, rpm, tpm, cooldown_seconds=60):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.cooldown_seconds = cooldown_seconds
+        self.available_requests = float(rpm)
+        self.available_tokens = float(tpm)
+        self._last_refill = time.monotonic()
+        self._cooldown_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def _rates(self):
+        """Current refill rates per second as (requests, tokens)"""
+        slowdown = 0.5 if time.monotonic() < self._cooldown_until else 1.0
+        return self.rpm / 60 * slowdown, self.tpm / 60 * slowdown
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        
+        request_rate, token_rate = self._rates()
+        self.available_requests = min(self.rpm, self.available_requests + elapsed * request_rate)
+        self.available_tokens = min(self.tpm, self.available_tokens + elapsed * token_rate)
+    
+    async def acquire(self, requests=1, tokens=0):
+        """Wait until both budgets can cover this call, then spend them"""
+        # A single request larger than the whole budget must still go through
+        tokens = min(tokens, self.tpm)
+        
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_requests >= requests and self.available_tokens >= tokens:
+                    self.available_requests -= requests
+                    self.available_tokens -= tokens
+                    return
+                
+                request_rate, token_rate = self._rates()
+                wait = max(
+                    (requests - self.available_requests) / request_rate,
+                    (tokens - self.available_tokens) / token_rate
+                )
+                await asyncio.sleep(wait)
+    
+    def settle(self, estimated_tokens, actual_tokens):
+        """Correct the token budget once a call's real input size is known"""
+        estimated_tokens = min(estimated_tokens, self.tpm)
+        self.available_tokens = min(self.tpm, self.available_tokens + estimated_tokens - actual_tokens)
+    
+    def penalize(self):
+        """Back off after a rate-limit error"""
+        self._cooldown_until = time.monotonic() + self.cooldown_seconds
+
+def trim_stage_1_context(stage_1, stage_2):
+    """
+    Shrink Stage 1 to what is needed to resolve Stage 2 references:
+    sentences naming an entity that also appears in Stage 2, plus the
+    last STAGE_1_TAIL_TOKENS tokens. Dropped stretches are marked "[...]".
+    """
+    entities = set(ENTITY_RE.findall(stage_2))
+    sentences = [sentence for sentence in SENTENCE_RE.findall(stage_1) if sentence]
+    
+    # Find where the tail window starts
+    tail_start = len(sentences)
+    tail_chars = 0
+    while tail_start > 0:
+        tail_chars += len(sentences[tail_start - 1])
+        if tail_chars > STAGE_1_TAIL_TOKENS * CHARS_PER_TOKEN:
+            break
+        tail_start -= 1
+    
+    kept = []
+    dropped = False
+    for i, sentence in enumerate(sentences):
+        mentions_entity = any(re.search(rf"\b{entity}\b", sentence) for entity in entities)
+        if i >= tail_start or mentions_entity:
+            if dropped:
+                kept.append("[...] ")
+                dropped = False
+            kept.append(sentence)
+        else:
+            dropped = True
+    
+    return ''.join(kept).strip()
+
+async def count_system_prompt_tokens(client, system_prompt):
+    """
+    Count the system prompt's tokens once with the token-counting API,
+    so rate limiting uses an exact figure for the largest part of each request
+    """
+    if system_prompt not in SYSTEM_PROMPT_TOKENS:
+        try:
+            result = await client.messages.count_tokens(
+                model=MODEL,
+                system=system_prompt,
+                messages=[{"role": "user", "content": "."}]
+            )
+            SYSTEM_PROMPT_TOKENS[system_prompt] = result.input_tokens
+        except Exception as e:
+            print(f"CAUTION: Could not count system prompt tokens ({e}); using an estimate")
+            SYSTEM_PROMPT_TOKENS[system_prompt] = len(system_prompt) // CHARS_PER_TOKEN
+    
+    return SYSTEM_PROMPT_TOKENS[system_prompt]
+
+def estimate_tokens(system_prompt, user_message):
+    """Rate-limited input tokens a request is expected to use"""
+    if system_prompt in CACHED_SYSTEM_PROMPTS:
+        system_tokens = 0
+    else:
+        system_tokens = SYSTEM_PROMPT_TOKENS.get(system_prompt, len(system_prompt) // CHARS_PER_TOKEN)
+    return system_tokens + len(user_message) // CHARS_PER_TOKEN
+
+def retry_delay(attempt, error):
+    """
+    Seconds to wait before retrying a failed call: the server's
+    Retry-After header when present, otherwise exponential backoff + jitter
+    """
+    if isinstance(error, APIStatusError):
+        retry_after = error.response.headers.get('retry-after')
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_BACKOFF_SECONDS)
+            except ValueError:
+                pass
+    
+    return min(2 ** (attempt - 1), MAX_BACKOFF_SECONDS) + random.uniform(0, 1)
+
+async def create_message_with_retries(client, semaphore, rate_limiter, system_prompt, user_message, **request):
+    """Send one request as a streamed message, retrying transient API errors"""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            # At most MAX_CONCURRENCY calls in flight,
+            # and only once the RPM/TPM budgets allow it
+            async with semaphore:
+                # Estimated once a slot is free, so calls queued behind the
+                # first response already skip the cached system prompt
+                estimated_tokens = estimate_tokens(system_prompt, user_message)
+                await rate_limiter.acquire(1, estimated_tokens)
+                # Streamed, because the SDK refuses non-streaming calls whose
+                # max_tokens could take over 10 minutes (above ~21k tokens)
+                async with client.messages.stream(**request) as stream:
+                    message = await stream.get_final_message()
+            
+            # Cache reads don't count towards the input-token limit
+            usage = message.usage
+            cache_writes = usage.cache_creation_input_tokens or 0
+            if cache_writes or usage.cache_read_input_tokens:
+                CACHED_SYSTEM_PROMPTS.add(system_prompt)
+            rate_limiter.settle(estimated_tokens, usage.input_tokens + cache_writes)
+            return message
+        except RETRYABLE_ERRORS as e:
+            if isinstance(e, RateLimitError):
+                rate_limiter.penalize()
+            if attempt == MAX_ATTEMPTS:
+                raise
+            
+            # Sleep outside the semaphore so other requests can proceed
+            await asyncio.sleep(retry_delay(attempt, e))
+
+@functools.lru_cache(maxsize=1)
 def load_system_prompt():
-    """Load Document 2 v3.1 prompt as system message"""
+    """
+    Load Document 2 v3.1 prompt as system message
+    (read once per process, so re-running main() doesn't re-read it)
+    """
     # Adjust this path to where you saved Document 2 v3.1
     prompt_path = Path('../prompts/stage2_prompt.md')
     
@@ -25,14 +303,19 @@ def load_system_prompt():
     with open(prompt_path, 'r', encoding='utf-8') as f:
         return f.read()
 
-def code_transcript_with_claude(client, system_prompt, transcript):
+def build_request(system_prompt, transcripts):
     """
-    Send one transcript to Claude API for coding
-    Returns: (coded_data, error_message)
+    Build the Messages API parameters for a group of transcripts
+    (shared by the live and Message Batches paths). A single transcript
+    gets the standard message; several are packed into one numbered message
+    so the system prompt is only paid for once.
     """
     
-    # Prepare the user message with Stage 1 and Stage 2
-    user_message = f"""Please code this transcript according to the instructions.
+    if len(transcripts) == 1:
+        transcript = transcripts[0]
+        
+        # Prepare the user message with Stage 1 and Stage 2
+        user_message = f"""Please code this transcript according to the instructions.
 
 Stage 1 Context (for reference only, do not code):
 {transcript['stage_1_context']}
@@ -45,78 +328,414 @@ Remember:
 - Check Stage 1 for repeated descriptors (don't count as new elaborations)
 - Code ONLY Stage 2 elements
 - Output valid JSON format"""
+    else:
+        blocks = []
+        for i, transcript in enumerate(transcripts, 1):
+            blocks.append(f"""=== Transcript {i} ===
+transcript_id: {transcript['participant_id']}
+
+Stage 1 Context (for reference only, do not code):
+{transcript['stage_1_context']}
+
+Stage 2 Story (CODE THIS):
+{transcript['stage_2_story']}""")
+        
+        user_message = f"""Please code each of the following {len(transcripts)} transcripts according to the instructions.
+Code every transcript independently - never let one transcript influence another.
+
+{chr(10).join(blocks)}
+
+Remember:
+- Use each transcript's own Stage 1 to understand context and resolve pronouns
+- Check Stage 1 for repeated descriptors (don't count as new elaborations)
+- Code ONLY Stage 2 elements
+- Output a single valid JSON object of the form {{"results": [...]}} with one coding object per transcript, in the same order, each with "transcript_id" set exactly as given above"""
+    
+    return {
+        'model': MODEL,
+        'max_tokens': min(MAX_TOKENS_PER_TRANSCRIPT * len(transcripts), MAX_OUTPUT_TOKENS),
+        'temperature': 0,  # Deterministic for consistency
+        # The system prompt is identical for every request, so mark it for
+        # prompt caching; only the user message varies between calls
+        'system': [
+            {
+                "type": "text",
+                "text": system_prompt,
+                "cache_control": {"type": "ephemeral"}
+            }
+        ],
+        'messages': [
+            {
+                "role": "user", # LLM uses "user" role for user messages
+                "content": user_message
+            }
+        ]
+    }
+
+def parse_claude_response(message):
+    """
+    Extract the coded JSON from a Claude message and attach API metadata
+    Returns: (coded_data, error_message)
+    """
+    
+    # Extract response text
+    response_text = message.content[0].text
     
+    # Parse JSON (Claude should return JSON)
+    # Handle markdown code blocks if present
+    match = JSON_FENCE_RE.search(response_text)
+    if match:
+        response_text = match.group(1)
+    
+    # Parse the JSON
     try:
-        # Call Claude API
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",  # Latest Sonnet 4
-            max_tokens=4096,
-            temperature=0,  # Deterministic for consistency
-            system=system_prompt,
-            messages=[
-                {
-                    "role": "user", # LLM uses "user" role for user messages
-                    "content": user_message
-                }
-            ]
-        )
-        
-        # Extract response text
-        response_text = message.content[0].text
-        
-        # Parse JSON (Claude should return JSON)
-        # Handle markdown code blocks if present
-        if '```json' in response_text:
-            # Extract JSON from ```json ... ``` blocks
-            json_start = response_text.find('```json') + 7
-            json_end = response_text.find('```', json_start)
-            response_text = response_text[json_start:json_end].strip()
-        elif '```' in response_text:
-            # Extract from generic code blocks
-            json_start = response_text.find('```') + 3
-            json_end = response_text.find('```', json_start)
-            response_text = response_text[json_start:json_end].strip()
-        
-        # Parse the JSON
-        coded_data = json.loads(response_text)
+        coded_data = orjson.loads(response_text)
+    except orjson.JSONDecodeError as e:
+        error_msg = f"JSON parsing error: {str(e)}\nResponse preview: {response_text[:300]}"
+        return None, error_msg
+    
+    # Add API metadata
+    coded_data['_api_metadata'] = {
+        'call_id': message.id,
+        'model': message.model,
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'input_tokens': message.usage.input_tokens,
+        'output_tokens': message.usage.output_tokens,
+        'cache_creation_input_tokens': message.usage.cache_creation_input_tokens or 0,
+        'cache_read_input_tokens': message.usage.cache_read_input_tokens or 0
+    }
+    
+    return coded_data, None
+
+def unpack_results(transcripts, coded_data):
+    """
+    Split a (possibly packed) response into one coding per transcript.
+    Token usage of a packed request is shared out across its transcripts
+    so that per-file totals still add up to what was billed.
+    Returns: list of (coded_data, error_message), aligned with transcripts
+    """
+    if len(transcripts) == 1:
+        return [(coded_data, None)]
+    
+    metadata = coded_data.pop('_api_metadata')
+    results = coded_data.get('results', [])
+    by_id = {r.get('transcript_id'): r for r in results if isinstance(r, dict)}
+    
+    n = len(transcripts)
+    shares = {field: divmod(metadata[field], n) for field in TOKEN_FIELDS}
+    
+    unpacked = []
+    for i, transcript in enumerate(transcripts):
+        entry = by_id.get(transcript['participant_id'])
+        if entry is None:
+            unpacked.append((None, "Transcript missing from packed response"))
+            continue
         
-        # Add API metadata
-        coded_data['_api_metadata'] = {
-            'call_id': message.id,
-            'model': message.model,
-            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
-            'input_tokens': message.usage.input_tokens,
-            'output_tokens': message.usage.output_tokens
+        entry['_api_metadata'] = {
+            **metadata,
+            **{field: share + (1 if i < extra else 0)
+               for field, (share, extra) in shares.items()},
+            'transcripts_in_request': n
         }
+        unpacked.append((entry, None))
+    
+    return unpacked
+
+async def code_transcript_with_claude(client, system_prompt, transcripts, semaphore, rate_limiter):
+    """
+    Send one group of transcripts to Claude API for coding
+    Returns: (coded_data, error_message)
+    """
+    request = build_request(system_prompt, transcripts)
+    user_message = request['messages'][0]['content']
+    
+    try:
+        # Call Claude API
+        message = await create_message_with_retries(
+            client, semaphore, rate_limiter, system_prompt, user_message, **request
+        )
+        return parse_claude_response(message)
         
-        return coded_data, None
-        
-    except json.JSONDecodeError as e:
-        error_msg = f"JSON parsing error: {str(e)}\nResponse preview: {response_text[:300]}"
+    except RateLimitError as e:
+        error_msg = f"Rate limit error after {MAX_ATTEMPTS} attempts: {str(e)}"
         return None, error_msg
         
     except Exception as e:
         error_msg = f"API error: {str(e)}"
         return None, error_msg
 
-def main():
+def cache_path(system_prompt, transcript):
+    """Location of the cached response for this exact model/prompt/transcript"""
+    key_data = {
+        'model': MODEL,
+        'sys': system_prompt,
+        's1': transcript['stage_1_context'],
+        's2': transcript['stage_2_story']
+    }
+    key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+    return CACHE_DIR / f"{key}.json"
+
+def load_all_coded():
+    """
+    Read the ALL_CODED_FILE written by the previous run
+    Returns: {participant_id: coded dict}
+    """
+    if not ALL_CODED_FILE.exists():
+        return {}
+    
+    with open(ALL_CODED_FILE, 'rb') as f:
+        records = [orjson.loads(line) for line in f if line.strip()]
+    return {record['participant_id']: record for record in records}
+
+def save_all_coded(all_coded):
+    """Write all coded transcripts to ALL_CODED_FILE, one JSON object per line"""
+    # Written to a temporary file first, so a crash mid-write can't leave a
+    # truncated ALL_CODED_FILE behind for the next run
+    tmp_file = ALL_CODED_FILE.with_name(ALL_CODED_FILE.name + '.tmp')
+    with open(tmp_file, 'wb') as f:
+        for coded_data in all_coded:
+            f.write(orjson.dumps(coded_data))
+            f.write(b'\n')
+    os.replace(tmp_file, ALL_CODED_FILE)
+
+def save_coded_result(output_file, coded_data, cache_file):
+    """
+    Write one coded transcript to the response cache and the output folder.
+    Blocking - call via asyncio.to_thread so serialization and disk I/O
+    stay off the event loop.
+    """
+    serialized = orjson.dumps(coded_data, option=orjson.OPT_INDENT_2)
+    with open(cache_file, 'wb') as f:
+        f.write(serialized)
+    shutil.copyfile(cache_file, output_file)
+
+async def save_group_results(group, coded_data, error):
+    """
+    Persist each transcript's coding from one response as soon as it
+    returns, so partial progress survives a crash mid-run
+    Returns: list of Result
+    """
+    transcripts = [transcript for transcript, _, _ in group]
+    if error:
+        unpacked = [(None, error)] * len(group)
+    else:
+        unpacked = unpack_results(transcripts, coded_data)
+    
+    outcomes = []
+    writes = []
+    for (transcript, output_file, cache_file), (coded, error) in zip(group, unpacked):
+        participant_id = transcript['participant_id']
+        
+        if error:
+            print(f"✗ {participant_id}: ERROR")
+            print(f"    {error}\n")
+            outcomes.append(Result(participant_id, error=error))
+            continue
+        
+        writes.append(asyncio.to_thread(save_coded_result, output_file, coded, cache_file))
+        print(f"✓ {participant_id}: Done")
+        metadata = coded['_api_metadata']
+        outcomes.append(Result(participant_id, coded,
+                               **{field: metadata.get(field, 0) for field in TOKEN_FIELDS}))
+    
+    # Write the group's files concurrently rather than one after another
+    await asyncio.gather(*writes)
+    return outcomes
+
+async def process_group(client, system_prompt, group, semaphore, rate_limiter):
+    """
+    Code one group of (transcript, output_file, cache_file) entries live
+    Returns: list of Result
+    """
+    transcripts = [transcript for transcript, _, _ in group]
+    coded_data, error = await code_transcript_with_claude(
+        client, system_prompt, transcripts, semaphore, rate_limiter
+    )
+    return await save_group_results(group, coded_data, error)
+
+def load_pending_batches(batch_file, groups, trim_context):
+    """
+    Find batches submitted by an earlier, interrupted run (see
+    code_transcripts_with_batch), so their results can be fetched instead
+    of paying for the same requests again
+    Returns: list of (batch_id, groups_by_id); empty if there is no
+             usable batch for these pending transcripts
+    Raises ValueError if the batches were sent with a different
+    --trim-context setting, whose responses would be cached under the
+    wrong keys
+    """
+    if not batch_file.exists():
+        return []
+    
+    with open(batch_file, 'rb') as f:
+        saved = orjson.loads(f.read())
+    
+    if saved['trim_context'] != trim_context:
+        flag = 'with' if saved['trim_context'] else 'without'
+        raise ValueError(f"{batch_file} holds batches submitted {flag} --trim-context; "
+                         f"re-run {flag} it to fetch their results, or delete the file "
+                         f"to discard them")
+    
+    entries = {entry[0]['participant_id']: entry for group in groups for entry in group}
+    requested = [pid for batch in saved['batches']
+                 for pids in batch['requests'].values() for pid in pids]
+    if not all(pid in entries for pid in requested):
+        print(f"CAUTION: Ignoring {batch_file} (its transcripts are no longer all pending)")
+        return []
+    
+    return [
+        (batch['batch_id'], {
+            custom_id: [entries[pid] for pid in pids]
+            for custom_id, pids in batch['requests'].items()
+        })
+        for batch in saved['batches']
+    ]
+
+def save_pending_batches(batch_file, batches, trim_context):
+    """Record submitted batches, so an interrupted run can fetch their results"""
+    with open(batch_file, 'wb') as f:
+        f.write(orjson.dumps({
+            'trim_context': trim_context,
+            'batches': [
+                {
+                    'batch_id': batch.id,
+                    'requests': {
+                        custom_id: [transcript['participant_id'] for transcript, _, _ in group]
+                        for custom_id, group in groups_by_id.items()
+                    }
+                }
+                for batch, groups_by_id in batches
+            ]
+        }, option=orjson.OPT_INDENT_2))
+
+async def code_transcripts_with_batch(client, system_prompt, groups, resumed, batch_file, trim_context):
+    """
+    Fetch the batches resumed from an earlier run, submit the pending
+    groups they don't cover as one new Message Batch, wait for each to
+    finish, then save each result as it is streamed back.
+    The batch IDs are kept in batch_file until all results are saved, so a
+    run that is interrupted while waiting picks the same batches up again.
+    Returns: list of Result
+    """
+    batches = []
+    for batch_id, groups_by_id in resumed:
+        try:
+            batch = await client.messages.batches.retrieve(batch_id)
+        except APIStatusError as e:
+            print(f"CAUTION: Could not retrieve batch {batch_id} ({e}); resubmitting its transcripts")
+            continue
+        print(f"✓ Resuming batch {batch.id} from an earlier run ({len(groups_by_id)} requests)")
+        batches.append((batch, groups_by_id))
+    
+    # Transcripts that became pending after those batches were submitted
+    # (or whose batch is gone) go in a new batch
+    in_flight = {
+        transcript['participant_id']
+        for _, groups_by_id in batches
+        for group in groups_by_id.values()
+        for transcript, _, _ in group
+    }
+    new_groups = [
+        [entry for entry in group if entry[0]['participant_id'] not in in_flight]
+        for group in groups
+    ]
+    new_groups = [group for group in new_groups if group]
+    
+    if new_groups:
+        groups_by_id = {}
+        requests = []
+        for i, group in enumerate(new_groups, 1):
+            transcripts = [transcript for transcript, _, _ in group]
+            # custom_id must be unique and <= 64 chars of [a-zA-Z0-9_-], which
+            # participant IDs (taken from file names) don't guarantee; the
+            # batch file maps it back to the participants
+            custom_id = f"req-{i}"
+            groups_by_id[custom_id] = group
+            requests.append({
+                'custom_id': custom_id,
+                'params': build_request(system_prompt, transcripts)
+            })
+        
+        batch = await client.messages.batches.create(requests=requests)
+        batches.append((batch, groups_by_id))
+        save_pending_batches(batch_file, batches, trim_context)
+        print(f"✓ Submitted batch {batch.id} ({len(requests)} requests)")
+    
+    print()
+    
+    # Keep streaming results while earlier ones are still being written
+    saves = []
+    for batch, groups_by_id in batches:
+        while batch.processing_status != 'ended':
+            await asyncio.sleep(BATCH_POLL_SECONDS)
+            batch = await client.messages.batches.retrieve(batch.id)
+            counts = batch.request_counts
+            print(f"  ... {batch.id} {batch.processing_status}: {counts.succeeded} succeeded, "
+                  f"{counts.errored} errored, {counts.processing} processing")
+        
+        async for entry in await client.messages.batches.results(batch.id):
+            if entry.result.type == 'succeeded':
+                # A malformed response fails only its own group, as in live mode
+                try:
+                    coded_data, error = parse_claude_response(entry.result.message)
+                except Exception as e:
+                    coded_data, error = None, f"Response parsing error: {str(e)}"
+            elif entry.result.type == 'errored':
+                coded_data, error = None, f"API error: {entry.result.error.error.message}"
+            else:
+                coded_data, error = None, f"Batch request {entry.result.type}"
+            
+            saves.append(asyncio.create_task(
+                save_group_results(groups_by_id[entry.custom_id], coded_data, error)
+            ))
+    
+    print()
+    
+    outcomes = [outcome for group_outcomes in await asyncio.gather(*saves)
+                for outcome in group_outcomes]
+    
+    # Every result is on disk now; a later run must not resume these batches
+    batch_file.unlink()
+    return outcomes
+
+async def main(live=False, batch_size=1, trim_context=False):
+    """
+    Code every prepared transcript and save the results
+    Returns: list of coded dicts (one per successfully coded participant,
+             including ones coded in earlier runs)
+    """
     print(f"{'='*60}")
     print("CLAUDE API CODING - BLIND PROTOCOL")
     print(f"{'='*60}\n")
     
+    if not 1 <= batch_size <= MAX_BATCH_SIZE:
+        print(f"❌ ERROR: batch size must be between 1 and {MAX_BATCH_SIZE}")
+        print(f"   ({MAX_TOKENS_PER_TRANSCRIPT} output tokens per transcript, "
+              f"{MAX_OUTPUT_TOKENS} per request)")
+        return []
+    
     # 1. Check API key
     api_key = os.getenv('LLM_API_KEY')
     if not api_key:
         print("❌ ERROR: LLM_API_KEY not found in .env file")
         print("\nPlease create a .env file with:")
         print("LLM_API_KEY=your-key-here")
-        return
+        return []
     
     print("✓ API key loaded")
     
     # 2. Initialize Anthropic client
-    client = Anthropic(api_key=api_key)
-    print("✓ Anthropic client initialized")
+    # One shared connection pool sized to the concurrency limit, so sockets
+    # are reused instead of opened per request
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=MAX_CONCURRENCY,
+            max_keepalive_connections=MAX_CONCURRENCY
+        )
+    )
+    # SDK-level retries are disabled; create_message_with_retries owns them
+    client = AsyncAnthropic(api_key=api_key, http_client=http_client, max_retries=0)
+    print(f"✓ Anthropic client initialized (max {MAX_CONCURRENCY} concurrent requests)")
     
     # 3. Load system prompt
     try:
@@ -126,23 +745,24 @@ def main():
     except FileNotFoundError as e:
         print(f"Ouch!!! Error: {e}")
         print("\nPlease ensure stage2_prompt.md is saved in the prompts/ folder")
-        return
+        return []
     
     # 4. Load prepared transcripts
     input_file = Path('data/processed/transcripts_prepared_masked_ok.json')
     if not input_file.exists():
         print(f"ERROR: Prepared transcripts not found: {input_file}")
         print("\nPlease run prepare_and_mask.py first")
-        return
+        return []
     
-    with open(input_file, 'r', encoding='utf-8') as f:
-        transcripts = json.load(f)
+    with open(input_file, 'rb') as f:
+        transcripts = orjson.loads(f.read())
     
     print(f"✓ Loaded {len(transcripts)} transcripts\n")
     
     # 5. Create output directory
     output_dir = Path('data/coded/llm_outputs')
     output_dir.mkdir(parents=True, exist_ok=True)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
     
     # 6. Process each transcript
     print(f"{'='*60}")
@@ -152,69 +772,154 @@ def main():
     results = []
     errors = []
     skipped = []
+    cache_hits = []
     
-    total_input_tokens = 0
-    total_output_tokens = 0
-    
-    for i, transcript in enumerate(transcripts, 1):
+    # Skip already-coded participants and serve cached responses
+    # before scheduling any API calls
+    pending = []
+    coded_by_id = {}
+    for transcript in transcripts:
         participant_id = transcript['participant_id']
-        
-        print(f"[{i}/{len(transcripts)}] Processing {participant_id}...", end=' ')
-        
-        # Check if already coded
         output_file = output_dir / f"{participant_id}_coded.json"
         if output_file.exists():
-            print("CAUTION: Already coded (skipping)")
+            print(f"CAUTION: {participant_id} already coded (skipping)")
             skipped.append(participant_id)
             continue
         
-        # Code transcript
-        coded_data, error = code_transcript_with_claude(client, system_prompt, transcript)
+        # Trim before computing the cache key, so the key matches what is sent
+        if trim_context:
+            transcript = {
+                **transcript,
+                'stage_1_context': trim_stage_1_context(
+                    transcript['stage_1_context'], transcript['stage_2_story']
+                )
+            }
         
-        if error:
-            print(f"✗ ERROR")
-            print(f"    {error}\n")
+        cache_file = cache_path(system_prompt, transcript)
+        if cache_file.exists():
+            # Keep the parsed copy for ALL_CODED_FILE rather than re-reading it later
+            with open(cache_file, 'rb') as f:
+                serialized = f.read()
+            with open(output_file, 'wb') as f:
+                f.write(serialized)
+            coded_by_id[participant_id] = orjson.loads(serialized)
+            print(f"✓ {participant_id}: Loaded from cache")
+            cache_hits.append(participant_id)
+            continue
+        
+        pending.append((transcript, output_file, cache_file))
+    
+    mode = 'live' if live else 'batch'
+    print(f"\nSending {len(pending)} transcripts to Claude "
+          f"({mode} mode, {batch_size} per request)...\n")
+    
+    # Pack transcripts into groups that share one request
+    groups = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+    
+    try:
+        if not groups:
+            outcomes = []
+        elif live:
+            # Fire all requests concurrently; each coroutine saves its own output
+            semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+            rate_limiter = AsyncLeakyBucket(RPM_LIMIT, TPM_LIMIT)
+            await count_system_prompt_tokens(client, system_prompt)
+            tasks = [
+                process_group(client, system_prompt, group, semaphore, rate_limiter)
+                for group in groups
+            ]
+            outcomes = [outcome for group_outcomes in await asyncio.gather(*tasks)
+                        for outcome in group_outcomes]
+        else:
+            batch_file = output_dir / '_pending_batch.json'
+            try:
+                resumed = load_pending_batches(batch_file, groups, trim_context)
+            except ValueError as e:
+                print(f"❌ ERROR: {e}")
+                return []
+            outcomes = await code_transcripts_with_batch(
+                client, system_prompt, groups, resumed, batch_file, trim_context
+            )
+    finally:
+        await client.close()
+    
+    for outcome in outcomes:
+        if outcome.error:
             errors.append({
-                'transcript_id': participant_id,
-                'error': error
+                'transcript_id': outcome.participant_id,
+                'error': outcome.error
             })
             continue
         
-        # Save result
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(coded_data, f, indent=2, ensure_ascii=False)
-        
-        # Track tokens
-        if '_api_metadata' in coded_data:
-            total_input_tokens += coded_data['_api_metadata']['input_tokens']
-            total_output_tokens += coded_data['_api_metadata']['output_tokens']
-        
-        results.append(participant_id)
-        print("✓ Done")
-        
-        # Rate limiting: 1 second between requests
-        if i < len(transcripts):
-            time.sleep(1)
+        results.append(outcome.participant_id)
+        coded_by_id[outcome.participant_id] = outcome.data
+    
+    # Track tokens
+    successes = [outcome for outcome in outcomes if not outcome.error]
+    token_totals = {
+        field: sum(getattr(outcome, field) for outcome in successes)
+        for field in TOKEN_FIELDS
+    }
+    
+    # Collect every participant's coding in memory. Participants coded in
+    # earlier runs come from the previous ALL_CODED_FILE (one read), unless
+    # their output file changed since it was written (e.g. corrected by
+    # hand) or is missing from it; those are read back from the file
+    previous = load_all_coded() if skipped else {}
+    previous_mtime = ALL_CODED_FILE.stat().st_mtime_ns if previous else 0
+    all_coded = []
+    for transcript in transcripts:
+        participant_id = transcript['participant_id']
+        coded_data = coded_by_id.get(participant_id)
+        if coded_data is None:
+            output_file = output_dir / f"{participant_id}_coded.json"
+            if not output_file.exists():
+                continue
+            if (participant_id in previous
+                    and output_file.stat().st_mtime_ns <= previous_mtime):
+                coded_data = previous[participant_id]
+            else:
+                with open(output_file, 'rb') as f:
+                    coded_data = orjson.loads(f.read())
+        all_coded.append({'participant_id': participant_id, **coded_data})
+    
+    save_all_coded(all_coded)
     
     # 7. Save summary
+    estimated_cost = sum(
+        token_totals[field] / 1_000_000 * PRICE_PER_MTOK[field]
+        for field in TOKEN_FIELDS
+    )
+    if not live:
+        estimated_cost *= BATCH_DISCOUNT
+    
     summary = {
+        'mode': mode,
+        'transcripts_per_request': batch_size,
+        'stage_1_trimmed': trim_context,
         'total_transcripts': len(transcripts),
         'successfully_coded': len(results),
         'already_coded': len(skipped),
+        'loaded_from_cache': len(cache_hits),
         'errors': len(errors),
         'error_details': errors,
+        'cache': {
+            'hits': len(cache_hits),
+            'misses': len(pending)
+        },
         'token_usage': {
-            'total_input_tokens': total_input_tokens,
-            'total_output_tokens': total_output_tokens,
-            'estimated_cost_usd': (total_input_tokens / 1_000_000 * 3.0) + 
-                                  (total_output_tokens / 1_000_000 * 15.0)
+            'total_input_tokens': token_totals['input_tokens'],
+            'total_output_tokens': token_totals['output_tokens'],
+            'prompt_cache_write_tokens': token_totals['cache_creation_input_tokens'],
+            'prompt_cache_read_tokens': token_totals['cache_read_input_tokens'],
+            'estimated_cost_usd': estimated_cost
         },
         'timestamp': time.strftime('%Y-%m-%d %H:%M:%S')
     }
     
     summary_file = output_dir / '_coding_summary.json'
-    with open(summary_file, 'w', encoding='utf-8') as f:
-        json.dump(summary, f, indent=2)
+    with open(summary_file, 'wb') as f:
+        f.write(orjson.dumps(summary, option=orjson.OPT_INDENT_2))
     
     # 8. Print final summary
     print(f"\n{'='*60}")
@@ -223,6 +928,7 @@ def main():
     print(f"Total transcripts: {len(transcripts)}")
     print(f"Successfully coded: {len(results)}")
     print(f"Already coded (skipped): {len(skipped)}")
+    print(f"Loaded from cache: {len(cache_hits)}")
     print(f"Errors: {len(errors)}")
     
     if errors:
@@ -233,14 +939,59 @@ def main():
     print(f"\n{'='*60}")
     print("TOKEN USAGE & COST")
     print(f"{'='*60}")
-    print(f"Input tokens: {total_input_tokens:,}")
-    print(f"Output tokens: {total_output_tokens:,}")
+    print(f"Input tokens: {token_totals['input_tokens']:,}")
+    print(f"Output tokens: {token_totals['output_tokens']:,}")
+    print(f"Prompt cache writes: {token_totals['cache_creation_input_tokens']:,} tokens")
+    print(f"Prompt cache reads: {token_totals['cache_read_input_tokens']:,} tokens")
     print(f"Estimated cost: ${summary['token_usage']['estimated_cost_usd']:.2f}")
     
     print(f"\n{'='*60}")
     print(f"✓ Results saved to: {output_dir}")
     print(f"✓ Summary saved to: {summary_file}")
+    print(f"✓ All coded transcripts saved to: {ALL_CODED_FILE}")
     print(f"{'='*60}\n")
+    
+    return all_coded
+
+def code_all(live=False, batch_size=1, trim_context=False):
+    """
+    Run the full coding step from Python and return the coded dicts, ready
+    to pass straight to coded_json_analyzer or merge_results_for_comparison
+    without re-reading the files.
+    Inside a running event loop (e.g. Jupyter) the coding runs on a worker
+    thread with its own loop; there, `await main(...)` also works directly.
+    """
+    coro = main(live=live, batch_size=batch_size, trim_context=trim_context)
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    
+    # asyncio.run() refuses to start a second loop in this thread
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Code masked transcripts with Claude")
+    parser.add_argument(
+        '--live', action='store_true',
+        help="Call the API directly instead of via the Message Batches API "
+             "(faster turnaround for small runs, but full price)"
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=1,
+        help=f"Number of transcripts packed into each request (default: 1, "
+             f"max: {MAX_BATCH_SIZE}). Larger values amortise the system "
+             f"prompt across transcripts"
+    )
+    parser.add_argument(
+        '--trim-context', action='store_true',
+        help="Send only the parts of Stage 1 that mention names used in Stage 2, "
+             "plus its last ~500 tokens (fewer input tokens, but less context "
+             "for the Stage 1 repetition check)"
+    )
+    args = parser.parse_args()
+    if not 1 <= args.batch_size <= MAX_BATCH_SIZE:
+        parser.error(f"--batch-size must be between 1 and {MAX_BATCH_SIZE}, so each "
+                     f"transcript gets {MAX_TOKENS_PER_TRANSCRIPT} output tokens")
+    asyncio.run(main(live=args.live, batch_size=args.batch_size, trim_context=args.trim_context))
\ No newline at end of file
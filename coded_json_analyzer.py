@@ -5,13 +5,15 @@ This script scans a folder for *_coded.json files, extracts creativity metrics,
 quality flags, and repetition checks, then outputs the results to both JSON and CSV formats.
 """
 
-import json
-import csv
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Union
 import logging
 
+import orjson
+import pandas as pd
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -35,11 +37,54 @@ def find_coded_json_files(folder_path: str) -> List[Path]:
         logger.error(f"Folder does not exist: {folder_path}")
         return []
     
-    coded_files = list(folder.glob("*_coded.json"))
+    # os.scandir returns file type info with each entry, avoiding the extra
+    # per-entry work of Path.glob on very large folders
+    with os.scandir(folder) as entries:
+        coded_files = [
+            Path(entry.path) for entry in entries
+            if entry.name.endswith("_coded.json") and entry.is_file(follow_symlinks=False)
+        ]
     logger.info(f"Found {len(coded_files)} coded JSON files")
     return coded_files
 
 
+def extract_metrics(data: Dict[str, Any], file_name: str) -> Dict[str, Any]:
+    """
+    Extract creativity metrics, quality flags, and repetition checks from one coded transcript.
+    
+    Args:
+        data: Parsed coded JSON for one transcript
+        file_name: Name of the coded JSON file the data belongs to
+        
+    Returns:
+        Dictionary containing extracted metrics
+    """
+    return {
+        'transcript_id': data.get('transcript_id', 'unknown'),
+        'file_name': file_name,
+        
+        # Creativity metrics
+        'fluency': data.get('creativity_metrics', {}).get('fluency', None),
+        'flexibility': data.get('creativity_metrics', {}).get('flexibility', None),
+        'elaboration_total': data.get('creativity_metrics', {}).get('elaboration_total', None),
+        'elaboration_density': data.get('creativity_metrics', {}).get('elaboration_density', None),
+        'categories_used': ', '.join(data.get('creativity_metrics', {}).get('categories_used', [])),
+        
+        # Quality flags
+        'unclear_audio': data.get('quality_flags', {}).get('unclear_audio', None),
+        'very_short_story': data.get('quality_flags', {}).get('very_short_story', None),
+        'very_long_story': data.get('quality_flags', {}).get('very_long_story', None),
+        'unusual_structure': data.get('quality_flags', {}).get('unusual_structure', None),
+        'quality_notes': data.get('quality_flags', {}).get('notes', ''),
+        
+        # Repetition check
+        'descriptors_in_stage_1_count': len(data.get('repetition_check', {}).get('descriptors_in_stage_1', [])),
+        'descriptors_repeated_in_stage_2_count': len(data.get('repetition_check', {}).get('descriptors_repeated_in_stage_2', [])),
+        'new_elaborations_in_stage_2': ', '.join(data.get('repetition_check', {}).get('new_elaborations_in_stage_2', [])),
+        'new_elaborations_count': len(data.get('repetition_check', {}).get('new_elaborations_in_stage_2', []))
+    }
+
+
 def extract_metrics_from_file(file_path: Path) -> Dict[str, Any]:
     """
     Extract creativity metrics, quality flags, and repetition checks from a single JSON file.
@@ -51,39 +96,18 @@ def extract_metrics_from_file(file_path: Path) -> Dict[str, Any]:
         Dictionary containing extracted metrics, or None if extraction fails
     """
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            data = json.load(file)
+        with open(file_path, 'rb') as file:
+            data = orjson.loads(file.read())
         
-        # Extract required fields
-        extracted_data = {
-            'transcript_id': data.get('transcript_id', 'unknown'),
-            'file_name': file_path.name,
-            
-            # Creativity metrics
-            'fluency': data.get('creativity_metrics', {}).get('fluency', None),
-            'flexibility': data.get('creativity_metrics', {}).get('flexibility', None),
-            'elaboration_total': data.get('creativity_metrics', {}).get('elaboration_total', None),
-            'elaboration_density': data.get('creativity_metrics', {}).get('elaboration_density', None),
-            'categories_used': ', '.join(data.get('creativity_metrics', {}).get('categories_used', [])),
-            
-            # Quality flags
-            'unclear_audio': data.get('quality_flags', {}).get('unclear_audio', None),
-            'very_short_story': data.get('quality_flags', {}).get('very_short_story', None),
-            'very_long_story': data.get('quality_flags', {}).get('very_long_story', None),
-            'unusual_structure': data.get('quality_flags', {}).get('unusual_structure', None),
-            'quality_notes': data.get('quality_flags', {}).get('notes', ''),
-            
-            # Repetition check
-            'descriptors_in_stage_1_count': len(data.get('repetition_check', {}).get('descriptors_in_stage_1', [])),
-            'descriptors_repeated_in_stage_2_count': len(data.get('repetition_check', {}).get('descriptors_repeated_in_stage_2', [])),
-            'new_elaborations_in_stage_2': ', '.join(data.get('repetition_check', {}).get('new_elaborations_in_stage_2', [])),
-            'new_elaborations_count': len(data.get('repetition_check', {}).get('new_elaborations_in_stage_2', []))
-        }
+        extracted_data = extract_metrics(data, file_path.name)
         
-        logger.info(f"Successfully extracted metrics from {file_path.name}")
+        # Per-file success is only interesting when debugging; the summary
+        # line in collect_all_metrics covers the normal case
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Successfully extracted metrics from %s", file_path.name)
         return extracted_data
         
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"Failed to parse JSON in {file_path.name}: {e}")
         return None
     except Exception as e:
@@ -91,23 +115,79 @@ def extract_metrics_from_file(file_path: Path) -> Dict[str, Any]:
         return None
 
 
-def collect_all_metrics(folder_path: str) -> List[Dict[str, Any]]:
+def load_coded_jsonl(file_path: str) -> List[Dict[str, Any]]:
     """
-    Collect metrics from all coded JSON files in the specified folder.
+    Load coded transcripts from a JSON-Lines file (e.g. all_coded.jsonl).
     
     Args:
-        folder_path: Path to the folder containing coded JSON files
+        file_path: Path to the JSON-Lines file, one coded transcript per line
+        
+    Returns:
+        List of coded transcript dictionaries
+    """
+    with open(file_path, 'rb') as file:
+        return [orjson.loads(line) for line in file if line.strip()]
+
+
+def is_newer_than_outputs(jsonl_path: str, folder: str) -> bool:
+    """
+    Check whether a JSON-Lines file is at least as recent as every coded
+    JSON file in a folder, i.e. no file was edited or re-coded after it.
+    
+    Args:
+        jsonl_path: Path to the JSON-Lines file (e.g. all_coded.jsonl)
+        folder: Folder containing the *_coded.json files
+        
+    Returns:
+        True if the JSON-Lines file exists and is up to date
+    """
+    if not Path(jsonl_path).exists():
+        return False
+    
+    jsonl_mtime = Path(jsonl_path).stat().st_mtime_ns
+    return all(file.stat().st_mtime_ns <= jsonl_mtime
+               for file in Path(folder).glob("*_coded.json"))
+
+
+def collect_all_metrics(source: Union[str, List[Dict[str, Any]]], max_workers: int = 16) -> List[Dict[str, Any]]:
+    """
+    Collect metrics from all coded transcripts.
+    
+    Coded transcripts can come from a folder of *_coded.json files, from a
+    single JSON-Lines file written by the coding step, or straight from
+    memory, so the pipeline doesn't have to re-read every file. Folder
+    files are read in parallel with a thread pool, since the scan is
+    dominated by file I/O.
+    
+    Args:
+        source: Folder containing coded JSON files, path to a .jsonl file,
+            or a list of coded transcript dictionaries
+        max_workers: Number of threads used to read files
         
     Returns:
-        List of dictionaries containing metrics from each file
+        List of dictionaries containing metrics from each transcript
     """
-    coded_files = find_coded_json_files(folder_path)
-    all_metrics = []
+    if isinstance(source, (str, Path)) and Path(source).suffix == '.jsonl':
+        source = load_coded_jsonl(source)
     
-    for file_path in coded_files:
-        metrics = extract_metrics_from_file(file_path)
-        if metrics is not None:
-            all_metrics.append(metrics)
+    if not isinstance(source, (str, Path)):
+        all_metrics = []
+        for data in source:
+            participant_id = data.get('participant_id') or data.get('transcript_id', 'unknown')
+            file_name = f"{participant_id}_coded.json"
+            try:
+                all_metrics.append(extract_metrics(data, file_name))
+            except Exception as e:
+                logger.error(f"Error processing {file_name}: {e}")
+        
+        logger.info(f"Successfully processed {len(all_metrics)} out of {len(source)} coded transcripts")
+        return all_metrics
+    
+    coded_files = find_coded_json_files(source)
+    
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(extract_metrics_from_file, coded_files)
+        all_metrics = [metrics for metrics in results if metrics is not None]
     
     logger.info(f"Successfully processed {len(all_metrics)} out of {len(coded_files)} files")
     return all_metrics
@@ -122,8 +202,8 @@ def save_to_json(data: List[Dict[str, Any]], output_path: str) -> None:
         output_path: Path where the JSON file should be saved
     """
     try:
-        with open(output_path, 'w', encoding='utf-8') as file:
-            json.dump(data, file, indent=2, ensure_ascii=False)
+        with open(output_path, 'wb') as file:
+            file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
         logger.info(f"Saved JSON summary to {output_path}")
     except Exception as e:
         logger.error(f"Failed to save JSON file: {e}")
@@ -142,13 +222,12 @@ def save_to_csv(data: List[Dict[str, Any]], output_path: str) -> None:
         return
     
     try:
-        # Get all keys from the first dictionary (assuming all have same structure)
-        fieldnames = list(data[0].keys())
-        
-        with open(output_path, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(data)
+        # Columns follow the keys of the first dictionary (all share the same
+        # structure); pandas' C writer handles the rows. dtype=object keeps
+        # integer counts as integers when some files have missing values.
+        # Rows end in \r\n, as the csv module writes them.
+        pd.DataFrame(data, dtype=object).to_csv(output_path, index=False, encoding='utf-8',
+                                                lineterminator='\r\n')
         
         logger.info(f"Saved CSV summary to {output_path}")
     except Exception as e:
@@ -161,14 +240,19 @@ def main():
     """
     # Configuration
     input_folder = "../data/coded/llm_outputs"
+    # Single file with every coded transcript, written by the coding step;
+    # read instead of the folder unless a coded file has changed since
+    all_coded_path = "../data/coded/all_coded.jsonl"
     output_json_path = "../data/coded/creativity_metrics_summary.json"
     output_csv_path = "../data/coded/creativity_metrics_summary.csv"
     
+    source = all_coded_path if is_newer_than_outputs(all_coded_path, input_folder) else input_folder
+    
     logger.info("Starting creativity metrics extraction")
-    logger.info(f"Input folder: {input_folder}")
+    logger.info(f"Input: {source}")
     
     # Collect metrics from all files
-    all_metrics = collect_all_metrics(input_folder)
+    all_metrics = collect_all_metrics(source)
     
     if not all_metrics:
         logger.warning("No metrics collected. Exiting.")
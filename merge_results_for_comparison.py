@@ -14,38 +14,126 @@ Author: Dotun's Research Assistant
 Date: January 2026
 """
 
+import argparse
+import functools
+import hashlib
+import importlib.util
+import pickle
 import pandas as pd
 import numpy as np
-import json
+import orjson
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from scipy.stats import pearsonr
-from sklearn.metrics import mean_absolute_error
-import matplotlib.pyplot as plt
-import seaborn as sns
+
+# scipy, matplotlib and pingouin are slow to import (pingouin alone pulls in
+# matplotlib and seaborn), so they are imported inside the functions that
+# use them rather than whenever this module is loaded
 
 # Optional: for ICC calculation
-try:
-    import pingouin as pg
-    PINGOUIN_AVAILABLE = True
-except ImportError:
-    PINGOUIN_AVAILABLE = False
+PINGOUIN_AVAILABLE = importlib.util.find_spec('pingouin') is not None
+if not PINGOUIN_AVAILABLE:
     print("Warning: pingouin not installed. ICC calculation will be skipped.")
     print("Install with: pip install pingouin --break-system-packages")
 
 
+# ============================================================================
+# INPUT CACHE
+# ============================================================================
+
+# Loaded inputs are pickled here together with the input files' mtimes and
+# sizes, so re-running the analysis on unchanged inputs skips the parsing
+CACHE_DIR = Path.home() / '.cache' / 'analysis2'
+
+# Hash of this script, stored with each cached result: editing a loader (or
+# a helper it calls) invalidates results loaded by the old code
+CODE_VERSION = hashlib.sha256(Path(__file__).read_bytes()).hexdigest()[:16]
+
+
+def _input_fingerprint(path):
+    """
+    Identify the current state of an input: (path, [(name, mtime, size), ...])
+    for a file, or for every *_coded.json file in a folder.
+    """
+    
+    path = Path(path).resolve()
+    files = sorted(path.glob('*_coded.json')) if path.is_dir() else [path]
+    entries = []
+    for file in files:
+        stat = file.stat()
+        entries.append((file.name, stat.st_mtime_ns, stat.st_size))
+    return str(path), entries
+
+
+def _mtime_cached(func):
+    """
+    Cache a loader's result on disk until its input file(s) or this
+    script's code change.
+    
+    There is one cache file per loader and input, overwritten whenever the
+    input changes. Only path inputs are cached; in-memory inputs are passed
+    straight through.
+    """
+    
+    @functools.wraps(func)
+    def wrapper(source, *args, **kwargs):
+        if not isinstance(source, (str, Path)) or not Path(source).exists():
+            return func(source, *args, **kwargs)
+        
+        fingerprint = (*_input_fingerprint(source), CODE_VERSION)
+        key_data = (fingerprint[0], args, sorted(kwargs.items()))
+        key = hashlib.sha256(pickle.dumps(key_data)).hexdigest()[:16]
+        cache_file = CACHE_DIR / f"{func.__name__}_{key}.pkl"
+        
+        if cache_file.exists():
+            try:
+                with open(cache_file, 'rb') as f:
+                    cached_fingerprint, result = pickle.load(f)
+                if cached_fingerprint == fingerprint:
+                    print(f"  ✓ Loaded {source} from cache ({cache_file})")
+                    return result
+            except Exception as e:
+                print(f"  ⚠ Ignoring unreadable cache file {cache_file}: {e}")
+        
+        result = func(source, *args, **kwargs)
+        
+        tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+        try:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            with open(tmp_file, 'wb') as f:
+                pickle.dump((fingerprint, result), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, cache_file)
+        except Exception as e:
+            print(f"  ⚠ Could not write cache file {cache_file}: {e}")
+            if tmp_file.exists():
+                tmp_file.unlink()
+        
+        return result
+    
+    return wrapper
+
+
 # ============================================================================
 # STEP 1: LOAD AND MERGE CLAUDE API JSON FILES
 # ============================================================================
 
+# Columns of the per-participant Claude DataFrame
+CLAUDE_NUMERIC_COLUMNS = ['Fluency_Claude', 'Flexibility_Claude',
+                          'Elaboration_Claude', 'ElabDensity_Claude']
+CLAUDE_COLUMNS = ['ParticipantID'] + CLAUDE_NUMERIC_COLUMNS + ['Categories_Claude']
+
+
+@_mtime_cached
 def load_claude_json_files(json_folder_path):
     """
     Load all JSON files from a folder and merge into single DataFrame.
     
     Parameters:
     -----------
-    json_folder_path : str
-        Path to folder containing JSON files (one per participant)
+    json_folder_path : str or list of dict
+        Path to folder containing JSON files (one per participant), path to
+        the all_coded.jsonl file written by the coding step, or the list of
+        coded dicts it returns (see code_all() in 2_run_llm_coding.py)
         
     Returns:
     --------
@@ -64,54 +152,112 @@ def load_claude_json_files(json_folder_path):
     }
     """
     
-    json_files = list(Path(json_folder_path).glob("*_coded.json"))
-    
-    if not json_files:
-        raise FileNotFoundError(f"No JSON files found in {json_folder_path}")
+    if isinstance(json_folder_path, (str, Path)) and Path(json_folder_path).suffix == '.jsonl':
+        with open(json_folder_path, 'rb') as f:
+            json_folder_path = [orjson.loads(line) for line in f if line.strip()]
     
-    print(f"Found {len(json_files)} JSON files to process")
+    if isinstance(json_folder_path, (str, Path)):
+        json_files = list(Path(json_folder_path).glob("*_coded.json"))
+        
+        if not json_files:
+            raise FileNotFoundError(f"No JSON files found in {json_folder_path}")
+        
+        print(f"Found {len(json_files)} JSON files to process")
+        
+        # Read and parse files in parallel (I/O-bound), then build the
+        # DataFrame in a single pass
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            loaded = list(executor.map(_load_claude_record, json_files))
+        names = [json_file.name for json_file in json_files]
+    else:
+        # Coded dicts already in memory: nothing to read or parse
+        if not json_folder_path:
+            raise ValueError("No coded transcripts to load")
+        
+        print(f"Found {len(json_folder_path)} coded transcripts to process")
+        
+        loaded = [_build_claude_record(data, data.get('participant_id', '')) for data in json_folder_path]
+        names = [data.get('participant_id', 'unknown') for data in json_folder_path]
     
     claude_data = []
-    
-    for json_file in json_files:
-        try:
-            with open(json_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            
-            # Extract relevant fields
-            # Adjust field names based on your actual JSON structure
-            participant_id = data.get('participant_id') or data.get('ParticipantID') or json_file.stem
-            participant_id = participant_id.split('_')[0]  # Clean ID if needed
-            
-            # Extract creativity metrics (nested structure)
-            creativity_metrics = data.get('creativity_metrics', {})
-            
-            record = {
-                'ParticipantID': participant_id,
-                'Fluency_Claude': creativity_metrics.get('fluency', np.nan),
-                'Flexibility_Claude': creativity_metrics.get('flexibility', np.nan),
-                'Elaboration_Claude': creativity_metrics.get('elaboration_total', np.nan),
-                'ElabDensity_Claude': creativity_metrics.get('elaboration_density', np.nan),
-                'Categories_Claude': ','.join(creativity_metrics.get('categories_used', [])) if isinstance(creativity_metrics.get('categories_used'), list) else creativity_metrics.get('categories_used', '')
-            }
-            
-            claude_data.append(record)
-            print(f"  ✓ Loaded: {participant_id}")
-            
-        except Exception as e:
-            print(f"  ✗ Error loading {json_file.name}: {e}")
+    for name, (record, error) in zip(names, loaded):
+        if error is not None:
+            print(f"  ✗ Error loading {name}: {error}")
             continue
+        claude_data.append(record)
+        print(f"  ✓ Loaded: {record['ParticipantID']}")
     
-    claude_df = pd.DataFrame(claude_data)
+    claude_df = pd.DataFrame.from_records(claude_data, columns=CLAUDE_COLUMNS)
+    claude_df['ParticipantID'] = claude_df['ParticipantID'].astype('category')
+    for col in CLAUDE_NUMERIC_COLUMNS:
+        claude_df[col] = pd.to_numeric(claude_df[col], errors='coerce')
     
     print(f"\nSuccessfully loaded {len(claude_df)} participant records")
     return claude_df
 
 
+def _all_coded_is_current(all_coded_file, json_folder_path):
+    """
+    Check whether all_coded.jsonl exists and is at least as recent as every
+    *_coded.json file, i.e. no file was edited or re-coded after it.
+    """
+    if not os.path.exists(all_coded_file):
+        return False
+    
+    all_coded_mtime = os.stat(all_coded_file).st_mtime_ns
+    return all(json_file.stat().st_mtime_ns <= all_coded_mtime
+               for json_file in Path(json_folder_path).glob("*_coded.json"))
+
+
+def _load_claude_record(json_file):
+    """
+    Read one Claude JSON file and extract its metrics record.
+    
+    Returns (record, None) on success or (None, error) on failure.
+    """
+    try:
+        with open(json_file, 'rb') as f:
+            data = orjson.loads(f.read())
+    except Exception as e:
+        return None, e
+    
+    return _build_claude_record(data, json_file.stem)
+
+
+def _build_claude_record(data, fallback_id):
+    """
+    Extract the metrics record from one parsed Claude JSON object.
+    
+    Returns (record, None) on success or (None, error) on failure.
+    """
+    try:
+        # Extract relevant fields
+        # Adjust field names based on your actual JSON structure
+        participant_id = data.get('participant_id') or data.get('ParticipantID') or fallback_id
+        participant_id = participant_id.split('_')[0]  # Clean ID if needed
+        
+        # Extract creativity metrics (nested structure)
+        creativity_metrics = data.get('creativity_metrics', {})
+        
+        record = {
+            'ParticipantID': participant_id,
+            'Fluency_Claude': creativity_metrics.get('fluency', np.nan),
+            'Flexibility_Claude': creativity_metrics.get('flexibility', np.nan),
+            'Elaboration_Claude': creativity_metrics.get('elaboration_total', np.nan),
+            'ElabDensity_Claude': creativity_metrics.get('elaboration_density', np.nan),
+            'Categories_Claude': ','.join(creativity_metrics.get('categories_used', [])) if isinstance(creativity_metrics.get('categories_used'), list) else creativity_metrics.get('categories_used', '')
+        }
+        return record, None
+        
+    except Exception as e:
+        return None, e
+
+
 # ============================================================================
 # STEP 2: LOAD MANUAL ELAN CODING FROM EXCEL
 # ============================================================================
 
+@_mtime_cached
 def load_manual_coding(excel_file_path):
     """
     Load manual ELAN coding results from Excel file.
@@ -190,45 +336,105 @@ def merge_datasets(manual_df, claude_df):
 # STEP 4: CALCULATE AGREEMENT STATISTICS
 # ============================================================================
 
-def calculate_agreement_statistics(merged_df):
+def _prepare_metric_arrays(merged_df, metrics):
+    """
+    Extract each metric's paired scores as NumPy arrays, once, for both the
+    statistics and the plots.
+    
+    A participant counts towards a metric only where both codings are
+    present, so rows are dropped per metric (not across all metrics) from
+    a single missing-value mask over every score column.
+    
+    Returns:
+    --------
+    dict of {metric: {'manual': np.ndarray, 'claude': np.ndarray, 'ids': np.ndarray}}
+    """
+    
+    manual = merged_df[[f'{m}_Manual' for m in metrics]].to_numpy(dtype=np.float64)
+    claude = merged_df[[f'{m}_Claude' for m in metrics]].to_numpy(dtype=np.float64)
+    valid = ~(np.isnan(manual) | np.isnan(claude))
+    ids = merged_df['ParticipantID'].to_numpy()
+    
+    return {
+        metric: {
+            'manual': manual[valid[:, i], i],
+            'claude': claude[valid[:, i], i],
+            'ids': ids[valid[:, i]]
+        }
+        for i, metric in enumerate(metrics)
+    }
+
+
+def _fast_pearson(x, y):
+    """
+    Pearson r from sums of products in a single pass over the data:
+    r = (Sxy - Sx*Sy/n) / sqrt((Sxx - Sx^2/n) * (Syy - Sy^2/n))
+    
+    Parameters:
+    -----------
+    x, y : np.ndarray
+        1-D arrays of paired scores, without missing values
+    """
+    
+    n = len(x)
+    sx = x.sum()
+    sy = y.sum()
+    sxy = x @ y
+    sxx = x @ x
+    syy = y @ y
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = (sxy - sx * sy / n) / np.sqrt((sxx - sx * sx / n) * (syy - sy * sy / n))
+    
+    # Rounding can push perfectly linear pairs just past +/-1, which would
+    # turn the p-value's t statistic into NaN
+    return np.clip(r, -1.0, 1.0)
+
+
+def calculate_agreement_statistics(merged_df, metric_arrays=None):
     """
     Calculate Pearson correlation, ICC, and MAE for each metric.
     
+    Parameters:
+    -----------
+    metric_arrays : dict, optional
+        Output of _prepare_metric_arrays, shared with create_visualizations;
+        built from merged_df if not given
+    
     Returns dictionary with all statistics.
     """
     
+    from scipy.stats import t as t_dist
+    
     metrics = ['Fluency', 'Flexibility', 'Elaboration']
     results = {}
     
+    if metric_arrays is None:
+        metric_arrays = _prepare_metric_arrays(merged_df, metrics)
+    
     print("\n" + "="*70)
     print("AGREEMENT STATISTICS")
     print("="*70)
     
     for metric in metrics:
-        manual_col = f'{metric}_Manual'
-        claude_col = f'{metric}_Claude'
+        manual = metric_arrays[metric]['manual']
+        claude = metric_arrays[metric]['claude']
+        n = len(manual)
         
-        # Remove any NaN values
-        valid_data = merged_df[[manual_col, claude_col]].dropna()
-        
-        if len(valid_data) == 0:
+        if n == 0:
             print(f"\n{metric}: No valid data")
             continue
         
-        manual_vals = valid_data[manual_col]
-        claude_vals = valid_data[claude_col]
-        
-        # Pearson correlation
-        corr, p_value = pearsonr(manual_vals, claude_vals)
-        
-        # Mean Absolute Error
-        mae = mean_absolute_error(manual_vals, claude_vals)
-        
-        # Mean difference
-        mean_diff = (manual_vals - claude_vals).mean()
-        
-        # Standard deviation of differences
-        std_diff = (manual_vals - claude_vals).std()
+        diff = manual - claude
+        with np.errstate(divide='ignore', invalid='ignore'):
+            corr = _fast_pearson(manual, claude)
+            std_diff = diff.std(ddof=1) if n > 1 else np.nan
+            
+            # Two-sided p-value for r (same test as scipy.stats.pearsonr)
+            t_stat = corr * np.sqrt((n - 2) / (1 - corr ** 2))
+        p_value = 2 * t_dist.sf(np.abs(t_stat), n - 2)
+        mae = np.abs(diff).mean()
+        mean_diff = diff.mean()
         
         results[metric] = {
             'correlation': corr,
@@ -236,7 +442,7 @@ def calculate_agreement_statistics(merged_df):
             'mae': mae,
             'mean_difference': mean_diff,
             'std_difference': std_diff,
-            'n': len(valid_data)
+            'n': n
         }
         
         # Print results
@@ -244,7 +450,7 @@ def calculate_agreement_statistics(merged_df):
         print(f"  Pearson r = {corr:.3f} (p = {p_value:.4f})")
         print(f"  MAE = {mae:.2f}")
         print(f"  Mean difference (Manual - Claude) = {mean_diff:.2f} ± {std_diff:.2f}")
-        print(f"  n = {len(valid_data)} participants")
+        print(f"  n = {n} participants")
         
         # Interpretation
         if corr >= 0.90:
@@ -262,9 +468,12 @@ def calculate_agreement_statistics(merged_df):
         print("Intraclass Correlation Coefficients (ICC)")
         print("-"*70)
         
-        for metric in metrics:
+        # Reshape every metric to long format in one pass
+        data_long = to_long_format(merged_df, metrics)
+        
+        for metric, metric_long in data_long.groupby('Metric', sort=False):
             try:
-                icc_result = calculate_icc(merged_df, metric)
+                icc_result = calculate_icc(metric_long)
                 results[metric]['icc'] = icc_result
                 print(f"\n{metric} ICC(2,1) = {icc_result:.3f}")
                 
@@ -283,23 +492,38 @@ def calculate_agreement_statistics(merged_df):
     return results
 
 
-def calculate_icc(df, metric):
+def to_long_format(df, metrics):
+    """
+    Reshape Manual/Claude score columns to long format for ICC calculation.
+    
+    Returns DataFrame with columns: ParticipantID, Score, Metric, Rater
+    """
+    
+    data_long = df.melt(
+        id_vars='ParticipantID',
+        value_vars=[f'{m}_{rater}' for m in metrics for rater in ('Manual', 'Claude')],
+        var_name='col',
+        value_name='Score'
+    )
+    data_long[['Metric', 'Rater']] = data_long['col'].str.rsplit('_', n=1, expand=True)
+    del data_long['col']
+    
+    return data_long
+
+
+def calculate_icc(data_long):
     """
     Calculate ICC(2,1) - two-way random effects, absolute agreement, single rater.
     
     This is the appropriate ICC for comparing two measurement methods.
-    """
     
-    # Reshape data to long format for ICC calculation
-    manual_col = f'{metric}_Manual'
-    claude_col = f'{metric}_Claude'
+    Parameters:
+    -----------
+    data_long : pd.DataFrame
+        One metric's scores in long format (see to_long_format)
+    """
     
-    # Create long format
-    data_long = pd.DataFrame({
-        'ParticipantID': list(df['ParticipantID']) + list(df['ParticipantID']),
-        'Rater': ['Manual']*len(df) + ['Claude']*len(df),
-        'Score': list(df[manual_col]) + list(df[claude_col])
-    })
+    import pingouin as pg
     
     # Remove NaN
     data_long = data_long.dropna()
@@ -337,14 +561,23 @@ def analyze_discrepancies(merged_df, threshold=2):
     print("="*70)
     
     metrics = ['Fluency', 'Flexibility', 'Elaboration']
+    diff_cols = [f'{m}_Diff' for m in metrics]
+    
+    # Differences for all metrics in one block operation (per-column dtypes
+    # are kept, so integer scores still print as integers)
+    diff = (merged_df[[f'{m}_Manual' for m in metrics]].set_axis(diff_cols, axis=1)
+            - merged_df[[f'{m}_Claude' for m in metrics]].set_axis(diff_cols, axis=1))
+    abs_diff = diff.abs()
+    
+    # Columns are added per metric: Fluency_Diff, Fluency_AbsDiff, ...
+    for metric, diff_col in zip(metrics, diff_cols):
+        merged_df[diff_col] = diff[diff_col]
+        merged_df[f'{metric}_AbsDiff'] = abs_diff[diff_col]
     
     for metric in metrics:
         manual_col = f'{metric}_Manual'
         claude_col = f'{metric}_Claude'
         
-        merged_df[f'{metric}_Diff'] = merged_df[manual_col] - merged_df[claude_col]
-        merged_df[f'{metric}_AbsDiff'] = abs(merged_df[f'{metric}_Diff'])
-        
         # Find large discrepancies
         discrepancies = merged_df[merged_df[f'{metric}_AbsDiff'] >= threshold]
         
@@ -361,67 +594,86 @@ def analyze_discrepancies(merged_df, threshold=2):
 # STEP 6: CREATE VISUALIZATIONS
 # ============================================================================
 
-def create_visualizations(merged_df, output_folder='validation_plots'):
+def create_visualizations(merged_df, output_folder='validation_plots', metric_arrays=None, dpi=150):
     """
     Create comparison plots: scatter plots and Bland-Altman plots.
+    
+    Parameters:
+    -----------
+    dpi : int
+        Resolution of the saved PNGs (use 300 for print-quality figures)
+    metric_arrays : dict, optional
+        Output of _prepare_metric_arrays, shared with
+        calculate_agreement_statistics; built from merged_df if not given
     """
     
+    # Plots are drawn on a standalone Figure, which renders with the Agg raster
+    # backend without switching pyplot's backend (keeps notebook plots inline)
+    from matplotlib.figure import Figure
+    
     os.makedirs(output_folder, exist_ok=True)
     
     metrics = ['Fluency', 'Flexibility', 'Elaboration']
     
+    if metric_arrays is None:
+        metric_arrays = _prepare_metric_arrays(merged_df, metrics)
+    
+    # One figure for all metrics; its axes are cleared and redrawn each time
+    fig = Figure(figsize=(14, 6))
+    ax1, ax2 = fig.subplots(1, 2)
+    
     for metric in metrics:
-        manual_col = f'{metric}_Manual'
-        claude_col = f'{metric}_Claude'
+        # Paired scores with missing values already removed
+        ids = metric_arrays[metric]['ids']
+        mx = metric_arrays[metric]['manual']
+        cy = metric_arrays[metric]['claude']
         
-        # Remove NaN
-        plot_data = merged_df[[manual_col, claude_col, 'ParticipantID']].dropna()
-        
-        if len(plot_data) == 0:
+        if len(ids) == 0:
             continue
         
-        # 1. Scatter plot with line of perfect agreement
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
+        ax1.clear()
+        ax2.clear()
         
+        # 1. Scatter plot with line of perfect agreement
         # Scatter plot
-        ax1.scatter(plot_data[manual_col], plot_data[claude_col], alpha=0.6, s=100)
+        ax1.scatter(mx, cy, alpha=0.6, s=100)
         
         # Add participant ID labels to points
-        for idx, row in plot_data.iterrows():
-            ax1.annotate(row['ParticipantID'], 
-                        (row[manual_col], row[claude_col]),
+        for pid, x, y in zip(ids, mx, cy):
+            ax1.annotate(pid, 
+                        (x, y),
                         xytext=(5, 5), 
                         textcoords='offset points',
                         fontsize=8,
                         alpha=0.7)
         
         # Line of perfect agreement
-        min_val = min(plot_data[manual_col].min(), plot_data[claude_col].min())
-        max_val = max(plot_data[manual_col].max(), plot_data[claude_col].max())
+        min_val = min(mx.min(), cy.min())
+        max_val = max(mx.max(), cy.max())
         ax1.plot([min_val, max_val], [min_val, max_val], 'r--', linewidth=2, label='Perfect Agreement')
         
         # Calculate correlation for title
-        corr, _ = pearsonr(plot_data[manual_col], plot_data[claude_col])
+        corr = _fast_pearson(mx, cy)
         
         ax1.set_xlabel('Manual Coding (ELAN)', fontsize=12)
         ax1.set_ylabel('Claude API Coding', fontsize=12)
-        ax1.set_title(f'{metric}: Manual vs Automated\nr = {corr:.3f}, n = {len(plot_data)}', fontsize=14)
+        ax1.set_title(f'{metric}: Manual vs Automated\nr = {corr:.3f}, n = {len(ids)}', fontsize=14)
         ax1.legend()
         ax1.grid(True, alpha=0.3)
         
         # 2. Bland-Altman plot
-        plot_data['Mean'] = (plot_data[manual_col] + plot_data[claude_col]) / 2
-        plot_data['Diff'] = plot_data[manual_col] - plot_data[claude_col]
+        mean_arr = 0.5 * (mx + cy)
+        diff_arr = mx - cy
         
-        mean_diff = plot_data['Diff'].mean()
-        std_diff = plot_data['Diff'].std()
+        mean_diff = diff_arr.mean()
+        std_diff = diff_arr.std(ddof=1)
         
-        ax2.scatter(plot_data['Mean'], plot_data['Diff'], alpha=0.6, s=100)
+        ax2.scatter(mean_arr, diff_arr, alpha=0.6, s=100)
         
         # Add participant ID labels to Bland-Altman points
-        for idx, row in plot_data.iterrows():
-            ax2.annotate(row['ParticipantID'], 
-                        (row['Mean'], row['Diff']),
+        for pid, x, y in zip(ids, mean_arr, diff_arr):
+            ax2.annotate(pid, 
+                        (x, y),
                         xytext=(5, 5), 
                         textcoords='offset points',
                         fontsize=8,
@@ -437,12 +689,12 @@ def create_visualizations(merged_df, output_folder='validation_plots'):
         ax2.legend()
         ax2.grid(True, alpha=0.3)
         
-        plt.tight_layout()
+        fig.tight_layout()
         
         output_path = os.path.join(output_folder, f'{metric}_comparison.png')
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
+        # Fast, light PNG compression: encoding dominates the save time
+        fig.savefig(output_path, dpi=dpi, pil_kwargs={'compress_level': 1})
         print(f"  ✓ Saved: {output_path}")
-        plt.close()
     
     print(f"\nAll plots saved to {output_folder}/")
 
@@ -456,46 +708,52 @@ def generate_summary_report(merged_df, results, output_file='validation_report.t
     Generate a text summary report of validation results.
     """
     
+    # Build the whole report in memory and write it in one go
+    parts = []
+    parts.append("="*70 + "\n")
+    parts.append("VALIDATION REPORT: Manual vs Automated Coding\n")
+    parts.append("Child-Robot Storytelling Creativity Study\n")
+    parts.append("="*70 + "\n\n")
+    
+    parts.append(f"Sample Size: {len(merged_df)} participants\n\n")
+    
+    parts.append("-"*70 + "\n")
+    parts.append("AGREEMENT STATISTICS\n")
+    parts.append("-"*70 + "\n\n")
+    
+    for metric, stats in results.items():
+        parts.append(f"{metric}:\n")
+        parts.append(f"  Pearson correlation: r = {stats['correlation']:.3f} (p = {stats['p_value']:.4f})\n")
+        
+        if 'icc' in stats:
+            parts.append(f"  ICC(2,1): {stats['icc']:.3f}\n")
+        
+        parts.append(f"  Mean Absolute Error: {stats['mae']:.2f}\n")
+        parts.append(f"  Mean Difference: {stats['mean_difference']:.2f} ± {stats['std_difference']:.2f}\n")
+        parts.append(f"  Sample size: n = {stats['n']}\n\n")
+    
+    parts.append("-"*70 + "\n")
+    parts.append("INTERPRETATION\n")
+    parts.append("-"*70 + "\n\n")
+    
+    # Overall assessment (plain sums - no arrays needed for a few metrics;
+    # with no metrics the averages are NaN and the conclusion is "Poor")
+    n_metrics = len(results) or float('nan')
+    avg_corr = sum(stats['correlation'] for stats in results.values()) / n_metrics
+    avg_mae = sum(stats['mae'] for stats in results.values()) / n_metrics
+    
+    if avg_corr >= 0.85 and avg_mae < 1.5:
+        parts.append("CONCLUSION: Excellent agreement between manual and automated coding.\n")
+        parts.append("Recommendation: Automated system is appropriate for coding remaining transcripts.\n")
+    elif avg_corr >= 0.70 and avg_mae < 2.5:
+        parts.append("CONCLUSION: Good to moderate agreement between manual and automated coding.\n")
+        parts.append("Recommendation: Consider using automated system with manual review of flagged cases.\n")
+    else:
+        parts.append("CONCLUSION: Poor agreement between manual and automated coding.\n")
+        parts.append("Recommendation: Manual coding required for all transcripts, or refine automated system.\n")
+    
     with open(output_file, 'w') as f:
-        f.write("="*70 + "\n")
-        f.write("VALIDATION REPORT: Manual vs Automated Coding\n")
-        f.write("Child-Robot Storytelling Creativity Study\n")
-        f.write("="*70 + "\n\n")
-        
-        f.write(f"Sample Size: {len(merged_df)} participants\n\n")
-        
-        f.write("-"*70 + "\n")
-        f.write("AGREEMENT STATISTICS\n")
-        f.write("-"*70 + "\n\n")
-        
-        for metric, stats in results.items():
-            f.write(f"{metric}:\n")
-            f.write(f"  Pearson correlation: r = {stats['correlation']:.3f} (p = {stats['p_value']:.4f})\n")
-            
-            if 'icc' in stats:
-                f.write(f"  ICC(2,1): {stats['icc']:.3f}\n")
-            
-            f.write(f"  Mean Absolute Error: {stats['mae']:.2f}\n")
-            f.write(f"  Mean Difference: {stats['mean_difference']:.2f} ± {stats['std_difference']:.2f}\n")
-            f.write(f"  Sample size: n = {stats['n']}\n\n")
-        
-        f.write("-"*70 + "\n")
-        f.write("INTERPRETATION\n")
-        f.write("-"*70 + "\n\n")
-        
-        # Overall assessment
-        avg_corr = np.mean([results[m]['correlation'] for m in results.keys()])
-        avg_mae = np.mean([results[m]['mae'] for m in results.keys()])
-        
-        if avg_corr >= 0.85 and avg_mae < 1.5:
-            f.write("CONCLUSION: Excellent agreement between manual and automated coding.\n")
-            f.write("Recommendation: Automated system is appropriate for coding remaining transcripts.\n")
-        elif avg_corr >= 0.70 and avg_mae < 2.5:
-            f.write("CONCLUSION: Good to moderate agreement between manual and automated coding.\n")
-            f.write("Recommendation: Consider using automated system with manual review of flagged cases.\n")
-        else:
-            f.write("CONCLUSION: Poor agreement between manual and automated coding.\n")
-            f.write("Recommendation: Manual coding required for all transcripts, or refine automated system.\n")
+        f.write(''.join(parts))
     
     print(f"\n✓ Summary report saved to {output_file}")
 
@@ -504,9 +762,16 @@ def generate_summary_report(merged_df, results, output_file='validation_report.t
 # MAIN EXECUTION FUNCTION
 # ============================================================================
 
-def main():
+def main(make_plots=True, make_report=True):
     """
     Main execution function - run the complete validation analysis.
+    
+    Parameters:
+    -----------
+    make_plots : bool
+        Create the comparison plots (by far the slowest step)
+    make_report : bool
+        Write validation_report.txt
     """
     
     print("\n" + "="*70)
@@ -520,6 +785,10 @@ def main():
     # Path to folder containing Claude API JSON files
     JSON_FOLDER = "../data/coded/llm_outputs"
     
+    # Single file with every coded transcript, written by the coding step;
+    # read instead of JSON_FOLDER unless a coded file has changed since
+    ALL_CODED_FILE = "../data/coded/all_coded.jsonl"
+    
     # Path to Excel file with manual ELAN coding
     MANUAL_EXCEL = "../data/coded/Elan_manual_coding.xlsx"
     
@@ -531,7 +800,8 @@ def main():
     try:
         # Step 1: Load Claude JSON files
         print("STEP 1: Loading Claude API JSON files...")
-        claude_df = load_claude_json_files(JSON_FOLDER)
+        claude_source = ALL_CODED_FILE if _all_coded_is_current(ALL_CODED_FILE, JSON_FOLDER) else JSON_FOLDER
+        claude_df = load_claude_json_files(claude_source)
         
         # Step 2: Load manual ELAN coding
         print("\nSTEP 2: Loading manual ELAN coding...")
@@ -549,29 +819,35 @@ def main():
         
         # Step 4: Calculate agreement statistics
         print("\nSTEP 4: Calculating agreement statistics...")
-        results = calculate_agreement_statistics(merged_df)
+        # Paired score arrays shared by the statistics and the plots
+        metric_arrays = _prepare_metric_arrays(merged_df, ['Fluency', 'Flexibility', 'Elaboration'])
+        results = calculate_agreement_statistics(merged_df, metric_arrays)
         
         # Step 5: Analyze discrepancies
         print("\nSTEP 5: Analyzing discrepancies...")
         merged_df = analyze_discrepancies(merged_df, threshold=2)
         
         # Create visualizations
-        print("\nSTEP 6: Creating visualizations...")
-        plot_folder = os.path.join(OUTPUT_FOLDER, "plots")
-        create_visualizations(merged_df, output_folder=plot_folder)
+        if make_plots:
+            print("\nSTEP 6: Creating visualizations...")
+            plot_folder = os.path.join(OUTPUT_FOLDER, "plots")
+            create_visualizations(merged_df, output_folder=plot_folder, metric_arrays=metric_arrays)
         
         # Step 7: Generate summary report
-        print("\nSTEP 7: Generating summary report...")
-        report_file = os.path.join(OUTPUT_FOLDER, "validation_report.txt")
-        generate_summary_report(merged_df, results, output_file=report_file)
+        if make_report:
+            print("\nSTEP 7: Generating summary report...")
+            report_file = os.path.join(OUTPUT_FOLDER, "validation_report.txt")
+            generate_summary_report(merged_df, results, output_file=report_file)
         
         print("\n" + "="*70)
         print("VALIDATION ANALYSIS COMPLETE!")
         print("="*70)
         print(f"\nAll outputs saved to: {OUTPUT_FOLDER}")
         print("  - merged_comparison.csv (combined dataset)")
-        print("  - validation_report.txt (summary statistics)")
-        print(f"  - plots/ (comparison visualizations)")
+        if make_report:
+            print("  - validation_report.txt (summary statistics)")
+        if make_plots:
+            print(f"  - plots/ (comparison visualizations)")
         
     except Exception as e:
         print(f"\n✗ Error during analysis: {e}")
@@ -601,7 +877,16 @@ def quick_stats(manual_excel, json_folder):
 # ============================================================================
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Compare manual ELAN coding with Claude API coding")
+    parser.add_argument('--no-plots', action='store_true',
+                        help="skip the comparison plots (statistics and report only)")
+    parser.add_argument('--no-report', action='store_true',
+                        help="skip writing validation_report.txt")
+    # parse_known_args: when run from the notebook via runpy, sys.argv holds
+    # the Jupyter kernel's own arguments
+    args, _ = parser.parse_known_args()
+    
+    main(make_plots=not args.no_plots, make_report=not args.no_report)
     
     # Alternatively, for quick stats only:
     # merged_df, results = quick_stats(
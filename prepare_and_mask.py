@@ -2,55 +2,100 @@
 Simple masking: Replace speaker labels only
 """
 
-import json
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import orjson
+
+# Speaker labels to mask, as one alternation so the text is scanned once
+_SPEAKER_RE = re.compile(r'\b(?:PEPPER|EXPERIMENTER)\s+\[')
+
+# Unmasked speaker labels that must not reach the LLM
+_LEAK_RE = re.compile(r'\b(ROBOT|EXPERIMENTER):')
+
+# Story continuation prompts that start Stage 2, in order of preference
+STAGE_2_MARKERS = [
+    'Stage 2',
+    'Stage B',
+    'What happened next?',
+    'What do you think happened next?',
+    'What do you think might happen?',
+]
+# All markers in one case-insensitive pattern; group i+1 matches STAGE_2_MARKERS[i]
+_STAGE2_RE = re.compile('|'.join(f'({re.escape(marker)})' for marker in STAGE_2_MARKERS), re.IGNORECASE)
+
 def mask_speaker_labels(text):
     """
     Replace ROBOT and EXPERIMENTER with generic PROMPT label
     Preserves all question content and interaction patterns
     """
-    # Replace ROBOT: with PROMPT:
-    text = re.sub(r'\bPEPPER\s+\[', 'PROMPT [', text)
-    
-    # Replace EXPERIMENTER: with PROMPT:
-    text = re.sub(r'\bEXPERIMENTER\s+\[', 'PROMPT [', text)
-    
-    return text
+    # Replace ROBOT and EXPERIMENTER labels with PROMPT in a single pass
+    return _SPEAKER_RE.sub('PROMPT [', text)
 
 def parse_transcript(filepath):
     """
     Parse transcript and separate Stage 1 and Stage 2
     Adjust this based on YOUR actual file format
     """
-    with open(filepath, 'r', encoding='utf-8') as f:
-        content = f.read()
+    content = filepath.read_text(encoding='utf-8')
     
     # Example parsing - adjust to your format
-    # Look for story continuation prompt
-    markers = [
-        'Stage 2',
-        'Stage B',
-        'What happened next?',
-        'What do you think happened next?',
-        'What do you think might happen?',
-    ]
-    
-    for marker in markers:
-        if marker.lower() in content.lower():
-            # Find position of marker (case-insensitive)
-            match = re.search(re.escape(marker), content, re.IGNORECASE)
-            if match:
-                split_pos = match.start()
-                stage_1 = content[:split_pos]
-                stage_2 = content[split_pos:]
-                return stage_1.strip(), stage_2.strip()
+    # Look for story continuation prompt (see STAGE_2_MARKERS) in a single
+    # pass; the first occurrence of the most preferred marker wins
+    match = None
+    for candidate in _STAGE2_RE.finditer(content):
+        if match is None or candidate.lastindex < match.lastindex:
+            match = candidate
+            if match.lastindex == 1:
+                break
+    
+    if match:
+        split_pos = match.start()
+        stage_1 = content[:split_pos]
+        stage_2 = content[split_pos:]
+        return stage_1.strip(), stage_2.strip()
     
     # If no marker found, return all as Stage 1
     print(f"No Stage 2 marker found in {filepath.name}")
     return content.strip(), ""
 
+def _process_one(file):
+    """
+    Parse and mask one transcript file (runs in a worker process)
+    Returns: (transcript, error_message, status_line) - transcript is None on failure
+    """
+    # Extract participant info from filename
+    # Adjust based on your naming convention
+    parts = file.stem.split('.')
+    participant_id = parts[0]  # e.g., P01
+    # age = parts[1] if len(parts) > 1 else 'Unknown'
+    
+    try:
+        # 1. Parse into Stage 1 and Stage 2
+        stage_1_raw, stage_2_raw = parse_transcript(file)
+        
+        if not stage_2_raw:
+            return (None, f"{participant_id}: No Stage 2 content",
+                    f"⚠️  {participant_id}: No Stage 2 found, skipping")
+        
+        # 3. Mask speaker labels
+        stage_1_masked = mask_speaker_labels(stage_1_raw)
+        stage_2_masked = mask_speaker_labels(stage_2_raw)
+        
+        # 4. Create transcript object
+        transcript = {
+            'participant_id': participant_id,
+            'stage_1_context': stage_1_masked,
+            'stage_2_story': stage_2_masked
+        }
+        
+        return transcript, None, f"✓ {participant_id}"
+        
+    except Exception as e:
+        return None, f"{participant_id}: {str(e)}", f"✗ {participant_id}: {e}"
+
 def main():
     # Setup paths
     raw_dir = Path('../data/raw/transcriptions')
@@ -63,63 +108,52 @@ def main():
         print(f"Please create it and add your transcript files")
         return
     
-    transcripts = []
+    processed = 0
     errors = []
-    
-    # Statistics
-    robot_count = 0
-    experimenter_count = 0
+    issues = []
     
     print(f"Processing transcripts from: {raw_dir}")
     print(f"{'='*60}\n")
     
-    # Process each transcript file
-    for file in sorted(raw_dir.glob('*.txt')):
-        # Extract participant info from filename
-        # Adjust based on your naming convention
-        parts = file.stem.split('.')
-        participant_id = parts[0]  # e.g., P01
-        # age = parts[1] if len(parts) > 1 else 'Unknown'
-        
-        try:
-            # 1. Parse into Stage 1 and Stage 2
-            stage_1_raw, stage_2_raw = parse_transcript(file)
-            
-            if not stage_2_raw:
-                print(f"⚠️  {participant_id}: No Stage 2 found, skipping")
-                errors.append(f"{participant_id}: No Stage 2 content")
+    # List the transcript files once
+    files = sorted(raw_dir.glob('*.txt'))
+    
+    # Process the transcript files in parallel; results come back in file order.
+    # Each masked transcript is written out as soon as it arrives, as one
+    # element of a 2-space indented JSON array, so the whole corpus is never
+    # held in memory (orjson writes UTF-8, non-ASCII characters unescaped)
+    tmp_file = output_file.with_name(output_file.name + '.tmp')
+    with ProcessPoolExecutor() as executor, open(tmp_file, 'wb') as f:
+        f.write(b'[')
+        for transcript, error, status_line in executor.map(_process_one, files, chunksize=16):
+            print(status_line)
+            if error:
+                errors.append(error)
                 continue
             
-            # 3. Mask speaker labels
-            stage_1_masked = mask_speaker_labels(stage_1_raw)
-            stage_2_masked = mask_speaker_labels(stage_2_raw)
-            
-            # 4. Create transcript object
-            transcript = {
-                'participant_id': participant_id,
-                'stage_1_context': stage_1_masked,
-                'stage_2_story': stage_2_masked
-            }
-            
-            transcripts.append(transcript)
-            print(f"✓ {participant_id}")
+            f.write(b',\n  ' if processed else b'\n  ')
+            f.write(orjson.dumps(transcript, option=orjson.OPT_INDENT_2).replace(b'\n', b'\n  '))
+            processed += 1
             
-        except Exception as e:
-            error_msg = f"{participant_id}: {str(e)}"
-            errors.append(error_msg)
-            print(f"✗ {participant_id}: {e}")
-    
-    # Save masked transcripts
-    if transcripts:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(transcripts, f, indent=2, ensure_ascii=False)
+            # Verify masking while the transcript is at hand
+            leak = _LEAK_RE.search(transcript['stage_1_context']) or _LEAK_RE.search(transcript['stage_2_story'])
+            if leak:
+                issues.append(f"{transcript['participant_id']}: {leak.group(1)} label still present")
+        f.write(b'\n]')
+    
+    # Save masked transcripts (an existing output is only replaced if
+    # something was processed)
+    if processed:
+        os.replace(tmp_file, output_file)
+    else:
+        tmp_file.unlink()
     
     # Print summary
     print(f"\n{'='*60}")
     print("PROCESSING SUMMARY")
     print(f"{'='*60}")
-    print(f"Files found: {len(list(raw_dir.glob('*.txt')))}")
-    print(f"Successfully processed: {len(transcripts)}")
+    print(f"Files found: {len(files)}")
+    print(f"Successfully processed: {processed}")
     print(f"Errors: {len(errors)}")
     
     if errors:
@@ -127,28 +161,11 @@ def main():
         for error in errors:
             print(f"  - {error}")
     
-    # print(f"\n{'='*60}")
-    # print("MASKING SUMMARY")
-    # print(f"{'='*60}")
-    # print(f"'ROBOT:' labels masked: {robot_count}")
-    # print(f"'EXPERIMENTER:' labels masked: {experimenter_count}")
-    # print(f"Total labels masked: {robot_count + experimenter_count}")
-    
     # Verification
     print(f"\n{'='*60}")
     print("VERIFICATION")
     print(f"{'='*60}")
     
-    issues = []
-    for t in transcripts:
-        full_text = t['stage_1_context'] + ' ' + t['stage_2_story']
-        
-        if 'ROBOT:' in full_text:
-            issues.append(f"{t['transcript_id']}: ROBOT label still present")
-        
-        if 'EXPERIMENTER:' in full_text:
-            issues.append(f"{t['transcript_id']}: EXPERIMENTER label still present")
-    
     if issues:
         print("Issues found:")
         for issue in issues: